@@ -0,0 +1,289 @@
+import sys
+import os
+import io
+import json
+import time
+import random
+import shutil
+import resource
+import tempfile
+import threading
+import contextlib
+import functools
+import http.server
+
+import geoip
+
+REGISTRIES = {
+    "APNIC": "apnic",
+    "AFRINIC": "afrinic",
+    "ARIN": "arin",
+    "LACNIC": "lacnic",
+    "RIPE": "ripencc",
+}
+
+# host counts of synthetic IPv4 delegations, the odd ones are not a power of two
+IPV4_COUNTS = [256] * 6 + [512] * 3 + [1024] * 4 + [2048, 4096, 8192, 16384, 65536, 768, 1280, 2560, 3072, 5120, 24576]
+# /8s of IPv4 space per registry
+IPV4_REGION = 40
+IPV6_PREFIXES = [29, 32, 32, 36, 40, 44, 48, 48]
+
+# a run is a regression once a stage is this much slower than the baseline
+TOLERANCE = 0.25
+# and by at least these many seconds, the short stages are mostly noise
+MIN_SLACK = 0.01
+
+
+def generate_table(rir, records, seed):
+    # synthetic delegated-extended file in the format of the real ones:
+    # comments, version line, summaries, asn/ipv4/ipv6 rows and some
+    # available and reserved blocks without a country
+    rnd = random.Random("{}-{}".format(seed, rir))
+    registry = REGISTRIES[rir]
+    countries = sorted(cc for cc, owner in geoip.ISO_RIR.items() if owner == rir)
+    # every registry gets a distinct part of the address space
+    region = (16 + IPV4_REGION * list(REGISTRIES).index(rir)) << 24
+    v4 = region
+    v6 = (0x2001 << 112) | ((0x100 * (list(REGISTRIES).index(rir) + 1)) << 96)
+    asn = 1000 + 100000 * list(REGISTRIES).index(rir)
+
+    rows = {"asn": [], "ipv4": [], "ipv6": []}
+    for i in range(records):
+        cc = rnd.choice(countries)
+        date = "20{:02d}{:02d}{:02d}".format(rnd.randrange(0, 26), rnd.randrange(1, 13), rnd.randrange(1, 29))
+        kind = rnd.random()
+        if kind < 0.2:
+            rows["asn"].append([registry, cc, "asn", str(asn), "1", date, "allocated"])
+            asn += 1
+        elif kind < 0.85:
+            count = rnd.choice(IPV4_COUNTS)
+            if rnd.random() < 0.3:
+                # leave a gap so not everything of a country is adjacent
+                v4 += 256 * rnd.randrange(1, 16)
+            if v4 + count > region + (IPV4_REGION << 24):
+                # very large tables start over at the beginning of the region
+                v4 = region + 256 * rnd.randrange(0, 256)
+            status = "available" if rnd.random() < 0.02 else "allocated"
+            rows["ipv4"].append([registry, "" if status == "available" else cc, "ipv4",
+                                 geoip.int_to_ip(v4, 32), str(count), date, status])
+            v4 += count
+        else:
+            prefixlen = rnd.choice(IPV6_PREFIXES)
+            size = 1 << (128 - prefixlen)
+            v6 = (v6 + size - 1) // size * size
+            status = "reserved" if rnd.random() < 0.02 else "assigned"
+            rows["ipv6"].append([registry, "ZZ" if status == "reserved" else cc, "ipv6",
+                                 geoip.int_to_ip(v6, 128), str(prefixlen), date, status])
+            v6 += size * rnd.randrange(1, 4)
+
+    lines = ["# synthetic {} delegations, seed {}".format(registry, seed)]
+    lines.append("2.3|{}|20261017|{}|19830613|20261016|+0000".format(registry, records))
+    for rtype in ("asn", "ipv4", "ipv6"):
+        lines.append("{}|*|{}|*|{}|summary".format(registry, rtype, len(rows[rtype])))
+    for rtype in ("asn", "ipv4", "ipv6"):
+        for row in rows[rtype]:
+            lines.append("|".join(row + ["{:08x}".format(rnd.getrandbits(32))]))
+    return "\n".join(lines) + "\n"
+
+
+def write_tables(directory, records, seed):
+    for rir in geoip.RIR_TABLES.keys():
+        name = geoip.RIR_TABLES[rir].rsplit("/", 1)[1]
+        with open(os.path.join(directory, name), "w") as f:
+            f.write(generate_table(rir, records, seed))
+
+
+@contextlib.contextmanager
+def serve(directory, handler_class = None):
+    # local stand-in for the RIR FTP servers, with Last-Modified/304 support
+    handler = functools.partial(handler_class or QuietHandler, directory=directory)
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield "http://127.0.0.1:{}".format(server.server_address[1])
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def reset():
+    for rir in geoip.CACHE.keys():
+        geoip.CACHE[rir] = {}
+    geoip.HEADERS.clear()
+
+
+def check_coverage(countries):
+    # every delegation must be covered by its CIDR blocks exactly
+    failures = 0
+    for cc in countries:
+        table, rows = geoip.select(cc, "all")
+        ranges = [geoip.row_range(table, row) for row in rows]
+        for bits in (32, 128):
+            family = [(start, count) for b, start, count in ranges if b == bits]
+            cidrs = iter(geoip.ranges_to_cidr(family, bits))
+            for start, count in family:
+                covered = start
+                while covered < start + count:
+                    network, prefixlen = next(cidrs)
+                    size = 1 << (bits - prefixlen)
+                    if network != covered or network % size:
+                        failures += 1
+                        break
+                    covered += size
+                if covered != start + count:
+                    failures += 1
+    return failures
+
+
+def hosts(cidr_list):
+    # IPv4 hosts -list yields for the prefixes
+    count = 0
+    for bits, network, prefixlen in cidr_list:
+        if bits == 32:
+            first, last = geoip.host_range(bits, network, prefixlen)
+            count += last - first + 1
+    return count
+
+
+def timed(results, stage, items):
+    def decorator(func):
+        # the comment lines of geoip are not part of the measurement
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - start
+            results[stage] = {"seconds": elapsed, "items": items() if callable(items) else items}
+        return func
+    return decorator
+
+
+def run(records, seed, countries, list_hosts):
+    results = {}
+    directory = tempfile.mkdtemp(prefix="geoip-bench-")
+    try:
+        write_tables(directory, records, seed)
+        geoip.CACHE_DIR = os.path.join(directory, "cache")
+        with serve(directory) as url:
+            geoip.MIRROR = url
+            total = records * len(geoip.RIR_TABLES)
+            reset()
+
+            @timed(results, "download+parse", total)
+            def _():
+                geoip.prefetch(geoip.RIR_TABLES.keys())
+
+            reset()
+
+            # nothing is parsed here, one conditional request per registry
+            @timed(results, "revalidate", len(geoip.RIR_TABLES))
+            def _():
+                geoip.prefetch(geoip.RIR_TABLES.keys())
+
+        ccs = countries if countries else sorted(geoip.ISO_RIR.keys())
+        ranges = {}
+
+        @timed(results, "filter", lambda: sum(len(geoip.select(cc, "all")[1]) for cc in ccs))
+        def _():
+            for cc in ccs:
+                geoip.select(cc, "all")
+
+        @timed(results, "cidr", lambda: sum(len(r) for r in ranges.values()))
+        def _():
+            for cc in ccs:
+                ranges[cc] = geoip.generate_range(cc, "all", True)
+
+        merged = [c for r in ranges.values() for c in r]
+
+        @timed(results, "aggregate", len(merged))
+        def _():
+            geoip.aggregate(merged)
+
+        @timed(results, "output", len(merged))
+        def _():
+            geoip.write_ipset(geoip.generate_sets("bench", merged, "all"), io.StringIO())
+
+        # expand the smallest countries until the host budget is spent
+        listed = []
+        budget = list_hosts
+        for cc in sorted(ccs, key=lambda cc: hosts(ranges[cc])):
+            if hosts(ranges[cc]) > budget:
+                break
+            budget -= hosts(ranges[cc])
+            listed.append(cc)
+
+        @timed(results, "list", list_hosts - budget)
+        def _():
+            with open(os.devnull, "w") as out:
+                for cc in listed:
+                    geoip.generate_list(cc, "ipv4", out)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            results["coverage_failures"] = check_coverage(ccs)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    # ru_maxrss is in KiB on Linux
+    results["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return results
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for stage, result in results.items():
+        if not isinstance(result, dict) or stage not in baseline:
+            continue
+        limit = max(baseline[stage]["seconds"] * (1 + tolerance), baseline[stage]["seconds"] + MIN_SLACK)
+        if result["seconds"] > limit:
+            regressions.append("{} took {:.3f}s, baseline {:.3f}s".format(stage, result["seconds"], baseline[stage]["seconds"]))
+    if "peak_rss_mb" in baseline and results["peak_rss_mb"] > baseline["peak_rss_mb"] * (1 + tolerance):
+        regressions.append("peak RSS {:.1f}MB, baseline {:.1f}MB".format(results["peak_rss_mb"], baseline["peak_rss_mb"]))
+    return regressions
+
+
+if __name__ == '__main__':
+    sys.argv.pop(0)
+    records = int(geoip.pop_option(sys.argv, "-records", 50000))
+    seed = int(geoip.pop_option(sys.argv, "-seed", 1))
+    # upper bound of the hosts expanded by the -list stage
+    list_hosts = int(geoip.pop_option(sys.argv, "-list-hosts", 1 << 23))
+    baseline_path = geoip.pop_option(sys.argv, "-baseline")
+    tolerance = float(geoip.pop_option(sys.argv, "-tolerance", TOLERANCE))
+    save = "-save" in sys.argv
+    if save:
+        sys.argv.remove("-save")
+    if "-no-numpy" in sys.argv:
+        sys.argv.remove("-no-numpy")
+        geoip.numpy = None
+    # the remaining arguments restrict the benchmark to these countries
+    countries = [cc for cc in sys.argv if cc in geoip.ISO_RIR.keys()]
+
+    results = run(records, seed, countries, list_hosts)
+    for stage, result in results.items():
+        if isinstance(result, dict):
+            rate = result["items"] / result["seconds"] if result["seconds"] else 0
+            print("# {:<16} {:>9.3f}s {:>12} items {:>14.0f}/s".format(stage, result["seconds"], result["items"], rate))
+    print("# peak RSS {:.1f}MB".format(results["peak_rss_mb"]))
+
+    status = 0
+    if results["coverage_failures"]:
+        print("# {} delegations not covered exactly by their CIDR blocks".format(results["coverage_failures"]))
+        status = 1
+
+    if baseline_path is not None and save:
+        with open(baseline_path, "w") as f:
+            json.dump(results, f, indent=2)
+        print("# Saved baseline to {}".format(baseline_path))
+    elif baseline_path is not None:
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        for regression in compare(results, baseline, tolerance):
+            print("# REGRESSION {}".format(regression))
+            status = 1
+
+    sys.exit(status)
@@ -1,11 +1,32 @@
-import math
 import sys
+import os
+import json
+import time
+import pickle
+import threading
+import mmap
+import array
+import bisect
+import contextlib
+import atexit
+import resource
+import cProfile
+import pstats
+import asyncio
+import signal
+import collections
+import struct
 import urllib3
-import io
 import ipaddress
+import socket
 import certifi
-from packaging import version
 import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 RIR_TABLES = {
     "APNIC": "https://ftp.apnic.net/stats/apnic/delegated-apnic-latest",
@@ -144,49 +165,450 @@ ISO_COUNTRY = {
     "ZM": "ZAMBIA",                                       "ZW": "ZIMBABWE",
 }
 
+# columnar table of every registry, see parse_list()
 CACHE = {
-    "APNIC": [],
-    "AFRINIC": [],
-    "ARIN": [],
-    "LACNIC": [],
-    "RIPE": []
+    "APNIC": {},
+    "AFRINIC": {},
+    "ARIN": {},
+    "LACNIC": {},
+    "RIPE": {}
 }
 
+# version, summary and the per type summaries of every loaded table
+HEADERS = {}
+
+# persistent on-disk cache of the parsed RIR tables, set to None to disable
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")), "geoip")
+# seconds a cached table is used without asking the RIR, 0 always revalidates
+CACHE_MAX_AGE = 0
+# never touch the network, only serve tables from CACHE_DIR
+OFFLINE = False
+# alternative base URL to fetch the delegation files from (e.g. a local mirror)
+MIRROR = None
+
+# bumped whenever the layout of the pickled tables changes
+CACHE_FORMAT = 3
+
+# values of the type column of a table
+TYPES = ("asn", "ipv4", "ipv6")
+TYPE_IDS = {rtype: i for i, rtype in enumerate(TYPES)}
+
+# size of the chunks the delegation files are streamed in
+CHUNK_SIZE = 64 * 1024
+# seconds to wait for a connection to a registry and for every read from it,
+# a stalled server must not hold up the other downloads forever
+HTTP_CONNECT_TIMEOUT = 10
+HTTP_READ_TIMEOUT = 60
+
+# vectorize the CIDR decomposition of IPv4 lists at least this long, if NumPy is available
+NUMPY_THRESHOLD = 1024
+
+# maxelem of the generated ipsets. `create -exist` fails once the parameters
+# differ from the existing set, so it must never depend on the set size. a
+# hash:net set only allocates what it holds, this is just the upper limit
+IPSET_MAXELEM = 1 << 20
+# family and name of the nftables table holding the generated sets
+NFT_TABLE = "inet geoip"
+# elements per `add element` statement in nftables batches
+NFT_CHUNK = 1024
+
+# -list refuses to expand more hosts than this per country and address family
+LIST_MAX_HOSTS = 1 << 24
+# report the -list progress on stderr
+LIST_PROGRESS = False
+# "0\n" .. "255\n", the last octet of listed IPv4 hosts
+OCTETS = ["{}\n".format(i) for i in range(256)]
+
+# the lookup index is rebuilt from the RIR tables once it is older than this
+INDEX_MAX_AGE = 86400
+# addresses resolved per batch by -lookup
+LOOKUP_BATCH = 65536
+# default Unix socket of the -serve lookup daemon
+SOCKET_PATH = "/run/geoip.sock"
+# addresses the daemon remembers the answer for
+SERVE_CACHE_SIZE = 65536
+# longest line the daemon waits for the end of, clients sending more are dropped
+SERVE_MAX_LINE = 1024
+# seconds between two checks of the daemon for a newer lookup index
+SERVE_RELOAD = 3600
+# allocations with these states belong to no country
+UNALLOCATED = ("available", "reserved")
+
+# per registry and per country measurements of this run, see write_metrics()
+METRICS = {
+    "started": time.time(),
+    "registries": {},
+    "countries": {},
+}
+
+# profilers of -profile, the first one is the main thread's, see profiled()
+PROFILERS = None
+
+# connection pool shared by all downloads, see http_pool()
+HTTP = None
+HTTP_LOCK = threading.Lock()
+
+
+class RIRUnavailable(Exception):
+    # neither a download nor a cached copy of a registry's table is available,
+    # carrying on would treat all its countries as having no allocations
+    pass
+
+
 def print_hi(name):
     # Use a breakpoint in the code line below to debug your script.
     print(f'Hi, {name}')  # Press Ctrl+F8 to toggle the breakpoint.
 
 
-def download_list(rir):
+def rir_url(rir):
+    if MIRROR is not None:
+        return "{}/{}".format(MIRROR.rstrip("/"), RIR_TABLES[rir].rsplit("/", 1)[1])
+    return RIR_TABLES[rir]
+
+
+def cache_path(rir, ext):
+    return os.path.join(CACHE_DIR, "{}.{}".format(rir.lower(), ext))
+
+
+def read_cache_meta(rir):
+    if CACHE_DIR is None:
+        return None
+    try:
+        with open(cache_path(rir, "json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def read_cache_table(rir):
+    try:
+        with open(cache_path(rir, "pickle"), "rb") as f:
+            return pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+        return None
+
+
+def write_cache(rir, meta, table = None, log = print):
+    if CACHE_DIR is None:
+        return
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        # write to a temporary file first so concurrent runs never see half a table
+        if table is not None:
+            with open(cache_path(rir, "pickle.tmp"), "wb") as f:
+                pickle.dump(table, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(cache_path(rir, "pickle.tmp"), cache_path(rir, "pickle"))
+        with open(cache_path(rir, "json.tmp"), "w") as f:
+            json.dump(meta, f)
+        os.replace(cache_path(rir, "json.tmp"), cache_path(rir, "json"))
+    except OSError as e:
+        log("# Could not write RIR cache for {}: {}".format(rir, e))
+
+
+def iter_lines(chunks):
+    # split a stream of byte chunks into lines without ever holding
+    # more than one chunk and the current partial line
+    rest = b""
+    for chunk in chunks:
+        lines = (rest + chunk).split(b"\n")
+        rest = lines.pop()
+        for line in lines:
+            yield line.decode("utf-8", "replace")
+    if rest:
+        yield rest.decode("utf-8", "replace")
+
+
+def parse_list(lines):
+    # the allocations are stored column wise instead of as rows of strings:
+    #   cc:       index into countries
+    #   type:     index into TYPES
+    #   start_hi: upper 64 bits of the first address, 0 for ipv4 and asn
+    #   start_lo: lower 64 bits of the first address or the first asn
+    #   value:    ipv4: count of hosts, ipv6: CIDR prefix length, asn: count
+    #   date:     YYYYMMDD, 0 if not given
+    #   status:   index into statuses
+    # the rows are indexed by (CC, type) right away, so looking up a
+    # country later is a single dict access. the opaque-id of the extended
+    # format is dropped
+    table = {
+        "header": [],
+        "registry": "",
+        "countries": [],
+        "statuses": [],
+        "cc": array.array("H"),
+        "type": array.array("B"),
+        "start_hi": array.array("Q"),
+        "start_lo": array.array("Q"),
+        "value": array.array("Q"),
+        "date": array.array("I"),
+        "status": array.array("B"),
+        "index": {},
+        "malformed": 0,
+    }
+    countries = {}
+    statuses = {}
+    index = table["index"]
+    mask = (1 << 64) - 1
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        n = line.split("|")
+        if len(table["header"]) < 4:
+            table["header"].append(n)
+            continue
+        try:
+            rtype = TYPE_IDS[n[2].lower()]
+            value = int(n[4])
+            if rtype == 0:
+                start = int(n[3])
+            else:
+                start, bits = ip_to_int(n[3])
+                # ipv4: at least one host within the address space,
+                # ipv6: a prefix length, anything else breaks row_range()
+                if bits != (32 if rtype == 1 else 128):
+                    raise ValueError("address of the wrong family")
+                if rtype == 1 and not 0 < value <= (1 << 32) - start:
+                    raise ValueError("count out of range")
+                if rtype == 2 and not 0 <= value <= 128:
+                    raise ValueError("prefix length out of range")
+            date = int(n[5]) if n[5] else 0
+            status = n[6]
+        except (IndexError, KeyError, OSError, ValueError):
+            table["malformed"] += 1
+            continue
+
+        cc = n[1].upper()
+        if cc not in countries:
+            countries[cc] = len(countries)
+            table["countries"].append(cc)
+        if status not in statuses:
+            statuses[status] = len(statuses)
+            table["statuses"].append(status)
+        table["registry"] = n[0]
+
+        row = len(table["type"])
+        table["cc"].append(countries[cc])
+        table["type"].append(rtype)
+        table["start_hi"].append(start >> 64)
+        table["start_lo"].append(start & mask)
+        table["value"].append(value)
+        table["date"].append(date)
+        table["status"].append(statuses[status])
+        try:
+            index[(cc, TYPES[rtype])].append(row)
+        except KeyError:
+            index[(cc, TYPES[rtype])] = array.array("I", (row,))
+
+    return table
+
+
+def table_row(table, row):
+    # the allocation as it appears in the delegation file
+    rtype = TYPES[table["type"][row]]
+    start = table["start_hi"][row] << 64 | table["start_lo"][row]
+    date = table["date"][row]
+    return (
+        table["registry"],
+        table["countries"][table["cc"][row]],
+        rtype,
+        str(start) if rtype == "asn" else int_to_ip(start, 32 if rtype == "ipv4" else 128),
+        str(table["value"][row]),
+        "{:08d}".format(date) if date else "",
+        table["statuses"][table["status"][row]],
+    )
+
+
+def row_range(table, row):
+    # -> (address bits, first address, number of addresses) of an allocation
+    start = table["start_hi"][row] << 64 | table["start_lo"][row]
+    if table["type"][row] == 1:
+        return 32, start, table["value"][row]
+    return 128, start, 1 << (128 - table["value"][row])
+
+
+def http_pool():
+    global HTTP
+    with HTTP_LOCK:
+        if HTTP is None:
+            # one connection per registry so a mirror serving all of them
+            # does not serialize the concurrent downloads
+            HTTP = urllib3.PoolManager(
+                maxsize=len(RIR_TABLES),
+                timeout=urllib3.Timeout(connect=HTTP_CONNECT_TIMEOUT, read=HTTP_READ_TIMEOUT),
+                cert_reqs='CERT_REQUIRED',
+                ca_certs=certifi.where()
+            )
+    return HTTP
+
+
+def open_url(url, headers = None):
+    return http_pool().request('GET', url, headers=headers, preload_content=False)
+
+
+def registry_metrics(rir):
+    return METRICS["registries"].setdefault(rir, {
+        "source": None,
+        "bytes": 0,
+        "download_seconds": 0.0,
+        "parse_seconds": 0.0,
+        "cache_seconds": 0.0,
+        "records": 0,
+    })
+
+
+def country_metrics(cc):
+    return METRICS["countries"].setdefault(cc, {
+        "filter_seconds": 0.0,
+        "generate_seconds": 0.0,
+        "allocations": 0,
+        "prefixes": 0,
+    })
+
+
+def counted(chunks, stats):
+    # account bytes and the time spent waiting for them, the time the
+    # consumer spends between two chunks is not included
+    started = time.perf_counter()
+    for chunk in chunks:
+        stats["bytes"] += len(chunk)
+        stats["download_seconds"] += time.perf_counter() - started
+        yield chunk
+        started = time.perf_counter()
+
+
+def profiled(func, *args):
+    # cProfile only sees the thread it was enabled in, so every worker
+    # gets a profiler of its own that write_profile() merges
+    if PROFILERS is None:
+        return func(*args)
+    profiler = cProfile.Profile()
+    PROFILERS.append(profiler)
+    profiler.enable()
+    try:
+        return func(*args)
+    finally:
+        profiler.disable()
+
+
+def fetch_list(rir, log = print):
+    stats = registry_metrics(rir)
+    table = timed_fetch_list(rir, stats, log)
+    stats["records"] = len(table["type"])
+    return table
+
+
+def stale_table(rir, meta, stats, log):
+    # a stale table is still better than no table at all
+    table = read_cache_table(rir) if meta is not None else None
+    if table is None:
+        stats["source"] = "missing"
+        raise RIRUnavailable("Download of RIR {} failed and there is no cached copy".format(rir))
+    log("# Using stale cached RIR for {} from {}".format(rir, time.ctime(meta["fetched"])))
+    stats["source"] = "stale"
+    return table
+
+
+def timed_fetch_list(rir, stats, log):
+    meta = read_cache_meta(rir)
+    url = rir_url(rir)
+
+    # validators from a different mirror are meaningless for this one
+    if meta is not None and meta.get("url") != url and not OFFLINE:
+        meta = None
+    if meta is not None and meta.get("format") != CACHE_FORMAT:
+        meta = None
+
+    if meta is not None and (OFFLINE or time.time() - meta["fetched"] < CACHE_MAX_AGE):
+        started = time.perf_counter()
+        table = read_cache_table(rir)
+        stats["cache_seconds"] += time.perf_counter() - started
+        if table is not None:
+            log("# Using cached RIR for {} from {}".format(rir, time.ctime(meta["fetched"])))
+            stats["source"] = "cache"
+            return table
+
+    if OFFLINE:
+        stats["source"] = "missing"
+        raise RIRUnavailable("No cached RIR for {} in offline mode".format(rir))
+
+    headers = {}
+    if meta is not None:
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    log("# Downloading RIR from {}".format(rir))
+    started = time.perf_counter()
+    try:
+        r = open_url(url, headers)
+    except urllib3.exceptions.HTTPError as e:
+        log("# Download of RIR {} failed: {}".format(rir, e))
+        r = None
+
+    stats["download_seconds"] += time.perf_counter() - started
+
+    if r is not None and r.status == 304:
+        r.release_conn()
+        started = time.perf_counter()
+        table = read_cache_table(rir)
+        stats["cache_seconds"] += time.perf_counter() - started
+        if table is not None:
+            log("# RIR {} not modified, using cache".format(rir))
+            stats["source"] = "not-modified"
+            meta["fetched"] = time.time()
+            write_cache(rir, meta, log=log)
+            return table
+        # the cache vanished underneath us, download unconditionally
+        try:
+            r = open_url(url)
+        except urllib3.exceptions.HTTPError as e:
+            log("# Download of RIR {} failed: {}".format(rir, e))
+            r = None
+
+    if r is None or r.status != 200:
+        if r is not None:
+            log("# Download of RIR {} failed with HTTP {}".format(rir, r.status))
+            r.release_conn()
+        return stale_table(rir, meta, stats, log)
+
+    # parse while the body is still arriving, a body that breaks off or
+    # stalls halfway is a failed download like any other
+    started = time.perf_counter()
+    waited = stats["download_seconds"]
+    try:
+        table = parse_list(iter_lines(counted(r.stream(CHUNK_SIZE), stats)))
+    except urllib3.exceptions.HTTPError as e:
+        log("# Download of RIR {} failed: {}".format(rir, e))
+        return stale_table(rir, meta, stats, log)
+    finally:
+        r.release_conn()
+    stats["parse_seconds"] += time.perf_counter() - started - (stats["download_seconds"] - waited)
+    stats["source"] = "download"
+
+    write_cache(rir, {
+        "url": url,
+        "format": CACHE_FORMAT,
+        "etag": r.headers.get("ETag"),
+        "last_modified": r.headers.get("Last-Modified"),
+        "fetched": time.time(),
+    }, table, log)
+
+    return table
+
+
+def download_list(rir, log = print):
     if rir not in RIR_TABLES.keys():
-        print("# Unknown RIR {}".format(rir))
+        log("# Unknown RIR {}".format(rir))
         return None
 
     if len(CACHE[rir]) > 0:
-        print("# Reusing RIR CACHE for {}".format(ISO_RIR[cc]))
-        rir_list = CACHE[rir]
+        log("# Reusing RIR CACHE for {}".format(rir))
+        table = CACHE[rir]
     else:
-        print("# Downloading RIR from {}".format(rir))
-        http = urllib3.PoolManager(
-            cert_reqs='CERT_REQUIRED',
-            ca_certs=certifi.where()
-        )
-        r = http.request('GET', RIR_TABLES[rir], preload_content=False)
-        if version.parse(urllib3.__version__) < version.parse("1.25"):
-            class ExplicitlyClosedHttpResponse(urllib3.HTTPResponse):
-                @property
-                def closed(self):
-                    return self._fp.closed
-            # change the class from standard urllib3.HttpResponse
-            r.__class__ = ExplicitlyClosedHttpResponse
-        else:
-            r.auto_close = False
-
-        rir_raw = [line.strip('\n').split("|") for line in io.TextIOWrapper(r) if not line.startswith("#")]
-        rir_header = rir_raw[:4]
-        rir_list = rir_raw[4:]
-
-        del rir_raw
+        table = fetch_list(rir, log)
+        rir_header = table["header"]
 
         rversion,registry,_,records,startdate,enddate,_  = rir_header[0]
         
@@ -199,107 +621,795 @@ def download_list(rir):
         except ValueError:
             enddate = "N/A"
 
-        print("# Got {}/{} v{} allocations from {}".format(len(rir_list), records, rversion, str(registry).upper()))
-        print("# {} - {}".format(startdate, enddate))
-        print("# {}:{} {}:{} {}:{}".format(rir_header[1][2], rir_header[1][4],rir_header[2][2], rir_header[2][4], rir_header[3][2], rir_header[3][4]))
-        CACHE[rir] = rir_list
+        log("# Got {}/{} v{} allocations from {}".format(len(table["type"]), records, rversion, str(registry).upper()))
+        log("# {} - {}".format(startdate, enddate))
+        log("# {}:{} {}:{} {}:{}".format(rir_header[1][2], rir_header[1][4],rir_header[2][2], rir_header[2][4], rir_header[3][2], rir_header[3][4]))
+        if table["malformed"]:
+            log("# Ignored {} malformed allocations".format(table["malformed"]))
+        HEADERS[rir] = rir_header
+        CACHE[rir] = table
     
-    return rir_list
+    return table
+
+
+def prefetch(rirs):
+    # download all missing tables at once, the total time is then bound by
+    # the slowest registry instead of the sum of all of them
+    rirs = [rir for rir in dict.fromkeys(rirs) if rir in RIR_TABLES.keys() and len(CACHE[rir]) == 0]
+    if len(rirs) == 0:
+        return
+
+    logs = {rir: [] for rir in rirs}
+    with ThreadPoolExecutor(max_workers=len(rirs)) as pool:
+        futures = [pool.submit(profiled, download_list, rir, logs[rir].append) for rir in rirs]
+    # keep the output in a stable order regardless of who finished first
+    for rir in rirs:
+        for line in logs[rir]:
+            print(line)
+    # raises the RIRUnavailable of the first registry that failed
+    for future in futures:
+        future.result()
 
     
 
-def filter(cc, net):
+def select(cc, net):
+    # -> (table, row ids) of the allocations of a country
     rir = ISO_RIR[cc]
     if len(CACHE[rir]) == 0:
         download_list(rir)
 
+    stats = country_metrics(cc)
+    started = time.perf_counter()
+
     print("# Filtering for {}".format(ISO_COUNTRY[cc]))
+    table = CACHE[rir]
+    index = table.get("index", {})
     if net == "all":
-        filtered_list = [n for n in CACHE[rir] if n[1].upper() == cc.upper() and n[2].lower() != "asn"]
+        rows = index.get((cc.upper(), "ipv4"), array.array("I")) + index.get((cc.upper(), "ipv6"), array.array("I"))
     else:
-        filtered_list = [n for n in CACHE[rir] if n[1].upper() == cc.upper() and n[2].lower() == net.lower()]
+        rows = index.get((cc.upper(), net.lower()), array.array("I"))
+
+    stats["filter_seconds"] += time.perf_counter() - started
+    stats["allocations"] += len(rows)
+
+    print("# Got {} allocations from {} for {}".format(len(rows), rir, ISO_COUNTRY[cc]))
+
+    return table, rows
+
+
+def filter(cc, net):
+    table, rows = select(cc, net)
+    return [table_row(table, row) for row in rows]
 
-    print("# Got {} allocations from {} for {}".format(len(filtered_list), rir, ISO_COUNTRY[cc]))
 
-    return filtered_list
+def ip_to_int(address):
+    # -> (integer value, address bits)
+    if ":" in address:
+        return int.from_bytes(socket.inet_pton(socket.AF_INET6, address), "big"), 128
+    return int.from_bytes(socket.inet_pton(socket.AF_INET, address), "big"), 32
+
+
+def int_to_ip(value, bits):
+    if bits == 32:
+        return socket.inet_ntop(socket.AF_INET, value.to_bytes(4, "big"))
+    # inet_ntop renders some v4-compatible addresses in dotted form, stick with ipaddress
+    return str(ipaddress.IPv6Address(value))
+
+
+def range_to_cidr(start, count, bits):
+    # decompose [start, start + count) into the minimal list of CIDR
+    # blocks. each block is as large as the alignment of its start and
+    # the number of remaining addresses allow
+    end = start + count
+    while start < end:
+        align = start & -start if start else 1 << bits
+        size = min(align, 1 << ((end - start).bit_length() - 1))
+        yield start, bits - size.bit_length() + 1
+        start += size
+
+
+def ranges_to_cidr_numpy(ranges):
+    # vectorized range_to_cidr for IPv4, every round peels the largest
+    # possible block off the front of all unfinished ranges at once
+    start = numpy.fromiter((r[0] for r in ranges), dtype=numpy.uint64, count=len(ranges))
+    end = start + numpy.fromiter((r[1] for r in ranges), dtype=numpy.uint64, count=len(ranges))
+    order = numpy.arange(len(ranges))
+    networks, prefixes, owners = [], [], []
+    while start.size:
+        align = start & (~start + numpy.uint64(1))
+        align[align == 0] = numpy.uint64(1 << 32)
+        # frexp is exact here, every value is well below 2**53
+        _, exp = numpy.frexp((end - start).astype(numpy.float64))
+        size = numpy.minimum(align, numpy.left_shift(numpy.uint64(1), (exp - 1).astype(numpy.uint64)))
+        _, exp = numpy.frexp(size.astype(numpy.float64))
+        networks.append(start)
+        prefixes.append(33 - exp)
+        owners.append(order)
+        start = start + size
+        left = start < end
+        start, end, order = start[left], end[left], order[left]
+    if not networks:
+        return []
+    networks = numpy.concatenate(networks)
+    prefixes = numpy.concatenate(prefixes)
+    # restore the input order, blocks of one range ascend by address
+    sort = numpy.lexsort((networks, numpy.concatenate(owners)))
+    return list(zip(networks[sort].tolist(), prefixes[sort].tolist()))
+
+
+def ranges_to_cidr(ranges, bits):
+    # [(start, count)] -> [(network, prefix length)], in input order
+    if bits == 32 and numpy is not None and len(ranges) >= NUMPY_THRESHOLD:
+        return ranges_to_cidr_numpy(ranges)
+    return [cidr for start, count in ranges for cidr in range_to_cidr(start, count, bits)]
 
 
 def generate_range(cc, net, quiet = False):
-    rir_list = filter(cc, net)
+    table, rows = select(cc, net)
+    started = time.perf_counter()
+    ranges = {32: [], 128: []}
+    for row in rows:
+        bits, start, count = row_range(table, row)
+        ranges[bits].append((start, count))
+
+    # list of (address bits, network, prefix length)
     return_list = []
-    # 0: registry
-    # 1: cc
-    # 2: type
-    # 3: start -> ipv4: count of hosts, ipv6: CIDR prefix length
-    # 4: value
-    # 5: date
-    # 6: status
-    for entry in rir_list:
-        # calculate the inital assumed network mask from the number of hosts
-        if entry[2] == "ipv4":
-            cidr_mask_inital = int(32 - math.log2(int(entry[4])))
+    for bits in (32, 128):
+        for network, prefixlen in ranges_to_cidr(ranges[bits], bits):
+            # print network range if not suppressed
+            if not quiet:
+                broadcast = network + (1 << (bits - prefixlen)) - 1
+                print("{}-{}".format(int_to_ip(network, bits), int_to_ip(broadcast, bits)))
+            return_list.append((bits, network, prefixlen))
+
+    stats = country_metrics(cc)
+    stats["generate_seconds"] += time.perf_counter() - started
+    stats["prefixes"] += len(return_list)
+
+    return return_list
+
+
+def merge_ranges(ranges):
+    # sort inclusive [start, end] intervals and collapse overlapping or adjacent ones
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            if end > merged[-1][1]:
+                merged[-1][1] = end
         else:
-            cidr_mask_inital = int(entry[4])
-
-        cidr_mask = cidr_mask_inital
-
-        shrink = True
-        # the network may not correspond with the calculated CIDR mask
-        # leading to cases where the network address has hostbits set
-        # i.e. the start address would be in the middle of the network
-        # in this case we need to shrink the network into smaller subnets
-        while shrink:
-            if cidr_mask > 128:
-                # implausible
-                raise Exception("Giving Up!")
-            try:
-                network = ipaddress.ip_network("{}/{}".format(entry[3], cidr_mask))
-                shrink = False # we are good and dont need to shrink
-            except ValueError:
-                # Shrink the network and try again
-                cidr_mask += 1
-                print("# Network duplication glitch {}/{}v{}".format(entry[3], cidr_mask_inital, cidr_mask))
-
-        # print network range if not suppressed
-        if not quiet:
-            print("{}-{}".format(format(network.network_address), format(network.broadcast_address)))
-
-        # add the working network
-        return_list.append(network)
-
-        # if we had to shrink the network add the missing network, after
-        # the working one
-        if cidr_mask != cidr_mask_inital:
-            # broadcast (last address) of the previous network
-            previous_broadcast = network.broadcast_address
-            for _ in range(cidr_mask - cidr_mask_inital):  # we have (cidr_mask - cidr_mask_inital) networks of size `cidr_mask` to add
-                # current network, immediated after the broadcast address of the previous
-                current_network = ipaddress.ip_network("{}/{}".format(format(previous_broadcast + 1), cidr_mask))
-                return_list.append(current_network)
-                # get the current broadcast address for the next itteration
-                previous_broadcast = current_network.broadcast_address
-                # print network range if not suppressed
-                if not quiet:
-                    print("{}-{}".format(format(current_network.network_address), format(current_network.broadcast_address)))
+            merged.append([start, end])
+    return merged
+
+
+def aggregate(cidr_list):
+    # collapse a list of (bits, network, prefix length) into the smallest
+    # equivalent one, works on plain integers per address family
+    return_list = []
+    for bits in (32, 128):
+        ranges = [(network, network + (1 << (bits - prefixlen)) - 1) for b, network, prefixlen in cidr_list if b == bits]
+        merged = merge_ranges(ranges)
+        for network, prefixlen in ranges_to_cidr([(start, end - start + 1) for start, end in merged], bits):
+            return_list.append((bits, network, prefixlen))
+
+    print("# Aggregated {} prefixes into {} ({:.1%} fewer)".format(
+        len(cidr_list), len(return_list), 1 - len(return_list) / len(cidr_list) if cidr_list else 0))
 
     return return_list
 
 
-def generate_cidr(cc, net):
-    for e in generate_range(cc, net, True):
-        print(format(e))
+def print_cidr(cidr_list):
+    for bits, network, prefixlen in cidr_list:
+        print("{}/{}".format(int_to_ip(network, bits), prefixlen))
+
+
+def generate_cidr(cc, net, aggregated = False):
+    cidr_list = generate_range(cc, net, True)
+    if aggregated:
+        cidr_list = aggregate(cidr_list)
+    print_cidr(cidr_list)
+
+
+def set_name(name, bits, style):
+    # ipset names as used by ipset.sh, nft identifiers cannot contain dashes
+    prefix = "ipnet" if bits == 32 else "ip6net"
+    if style == "nft":
+        return "{}_{}".format(prefix, name)
+    return "{}-{}".format(prefix, name)
+
+
+def write_ipset(sets, out):
+    # `ipset restore` script, every set is filled under a temporary name
+    # and swapped in as a whole, so the live set is never empty or partial.
+    # the live sets must exist already, ipset.sh creates the missing ones.
+    # they are not created here, `create -exist` would fail for a set made
+    # with other parameters while `swap` only needs type and family to match
+    for name, bits, cidr_list in sets:
+        family = "inet" if bits == 32 else "inet6"
+        live = set_name(name, bits, "ipset")
+        tmp = "{}-tmp".format(live)
+        out.write("create {} hash:net family {} maxelem {} -exist\n".format(tmp, family, IPSET_MAXELEM))
+        out.write("flush {}\n".format(tmp))
+        for _, network, prefixlen in cidr_list:
+            out.write("add {} {}/{}\n".format(tmp, int_to_ip(network, bits), prefixlen))
+        out.write("swap {} {}\n".format(tmp, live))
+        out.write("destroy {}\n".format(tmp))
+
+
+def write_nft(sets, out):
+    # `nft -f` batch, the whole file is applied as one transaction
+    out.write("add table {}\n".format(NFT_TABLE))
+    for name, bits, cidr_list in sets:
+        live = set_name(name, bits, "nft")
+        addr_type = "ipv4_addr" if bits == 32 else "ipv6_addr"
+        out.write("add set {} {} {{ type {}; flags interval; }}\n".format(NFT_TABLE, live, addr_type))
+        out.write("flush set {} {}\n".format(NFT_TABLE, live))
+        for i in range(0, len(cidr_list), NFT_CHUNK):
+            elements = ", ".join(
+                "{}/{}".format(int_to_ip(network, bits), prefixlen) for _, network, prefixlen in cidr_list[i:i + NFT_CHUNK]
+            )
+            out.write("add element {} {} {{ {} }}\n".format(NFT_TABLE, live, elements))
+
+
+def generate_sets(name, cidr_list, net):
+    # split aggregated prefixes into one set per address family,
+    # interval sets must not contain overlapping elements
+    cidr_list = aggregate(cidr_list)
+    families = {"ipv4": (32,), "ipv6": (128,)}.get(net, (32, 128))
+    return [(name, bits, [c for c in cidr_list if c[0] == bits]) for bits in families]
+
+
+def write_changes(changes, style, out):
+    # incremental update of sets that are already loaded
+    for name, bits, added, removed in changes:
+        if style == "nft":
+            live = set_name(name, bits, "nft")
+            # interval elements must not overlap, so drop the old ones first,
+            # the batch is one transaction so nothing slips through meanwhile
+            for verb, prefixes in (("delete", removed), ("add", added)):
+                for i in range(0, len(prefixes), NFT_CHUNK):
+                    elements = ", ".join(
+                        "{}/{}".format(int_to_ip(network, bits), prefixlen) for network, prefixlen in prefixes[i:i + NFT_CHUNK]
+                    )
+                    out.write("{} element {} {} {{ {} }}\n".format(verb, NFT_TABLE, live, elements))
+        else:
+            live = set_name(name, bits, "ipset")
+            # hash:net may overlap, add before deleting to never leave a gap
+            for network, prefixlen in added:
+                out.write("add {} {}/{} -exist\n".format(live, int_to_ip(network, bits), prefixlen))
+            for network, prefixlen in removed:
+                out.write("del {} {}/{} -exist\n".format(live, int_to_ip(network, bits), prefixlen))
+
+
+def write_sets(sets, style, path = None, changes = ()):
+    writer = write_nft if style == "nft" else write_ipset
+
+    def write(out):
+        if sets:
+            writer(sets, out)
+        write_changes(changes, style, out)
+
+    if path is None:
+        write(sys.stdout)
+        return
+    # replace the file only once it is complete
+    with open(path + ".tmp", "w") as f:
+        write(f)
+    os.replace(path + ".tmp", path)
+    print("# Wrote {} sets to {}".format(len(sets) + len(changes), path))
+
+
+def source_id(rir):
+    # serial and end date of a loaded table, they change with every new file
+    if rir not in HEADERS:
+        return None
+    return "{}/{}".format(HEADERS[rir][0][2], HEADERS[rir][0][5])
+
+
+def read_state(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        print("# Ignoring unreadable state {}: {}".format(path, e))
+        return None
+
+
+def write_state(path, state):
+    with open(path + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(path + ".tmp", path)
+
+
+def state_unchanged(state, sources, key):
+    # the sets recorded in the state are still current if neither the RIR
+    # tables nor the sets asked for have changed since it was written
+    return state is not None and state.get("sources") == sources and state.get("key") == key
+
+
+def diff_prefixes(old, new):
+    # both sorted lists of (network, prefix length) -> (added, removed)
+    added = []
+    removed = []
+    i = j = 0
+    while i < len(old) and j < len(new):
+        if old[i] == new[j]:
+            i += 1
+            j += 1
+        elif old[i] < new[j]:
+            removed.append(old[i])
+            i += 1
+        else:
+            added.append(new[j])
+            j += 1
+    removed.extend(old[i:])
+    added.extend(new[j:])
+    return added, removed
+
+
+def write_diff(sets, style, state_path, state, path = None):
+    # write only what changed since the sets recorded in the state, sets
+    # without a previous state are written in full
+    old_sets = state.get("sets", {}) if state is not None else {}
+    full = []
+    changes = []
+    new_sets = {}
+    count_added = count_removed = 0
+    for name, bits, cidr_list in sets:
+        live = set_name(name, bits, style)
+        new = [(network, prefixlen) for _, network, prefixlen in cidr_list]
+        new_sets[live] = new
+        if live not in old_sets:
+            full.append((name, bits, cidr_list))
+            count_added += len(new)
+            continue
+        added, removed = diff_prefixes([tuple(p) for p in old_sets[live]], new)
+        count_added += len(added)
+        count_removed += len(removed)
+        if added or removed:
+            changes.append((name, bits, added, removed))
+
+    print("# {} prefixes added, {} removed".format(count_added, count_removed))
+    write_sets(full, style, path, changes)
+    return new_sets
+
+
+def host_range(bits, network, prefixlen):
+    # first and last address yielded by ipaddress' hosts() for the network
+    last = network + (1 << (bits - prefixlen)) - 1
+    if prefixlen >= bits - 1:
+        return network, last
+    if bits == 32:
+        # without network and broadcast address
+        return network + 1, last - 1
+    # without the Subnet-Router anycast address
+    return network + 1, last
+
+
+def format_hosts(bits, first, last):
+    # yield the text of [first, last] in chunks, IPv4 a /24 at a time by
+    # prepending the first three octets to pre-rendered last octets
+    if bits == 32:
+        while first <= last:
+            block_last = min(last, first | 0xff)
+            prefix = int_to_ip(first & ~0xff, 32)[:-1]
+            yield "".join([prefix + octet for octet in OCTETS[first & 0xff:(block_last & 0xff) + 1]])
+            first = block_last + 1
+    else:
+        while first <= last:
+            block_last = min(last, first + 255)
+            yield "".join([int_to_ip(h, 128) + "\n" for h in range(first, block_last + 1)])
+            first = block_last + 1
+
+
+def generate_list(cc, net, out = None):
+    out = out if out is not None else sys.stdout
+    hosts = {32: [], 128: []}
+    for bits, network, prefixlen in generate_range(cc, net, True):
+        hosts[bits].append(host_range(bits, network, prefixlen))
+
+    for bits in (32, 128):
+        total = sum(last - first + 1 for first, last in hosts[bits])
+        if total > LIST_MAX_HOSTS:
+            print("# Refusing to list {} IPv{} hosts of {}, more than {} (see -max-hosts)".format(
+                total, 4 if bits == 32 else 6, ISO_COUNTRY[cc], LIST_MAX_HOSTS))
+            continue
+
+        done = 0
+        started = time.time()
+        reported = started
+        buffered = []
+        size = 0
+        for first, last in hosts[bits]:
+            for chunk in format_hosts(bits, first, last):
+                buffered.append(chunk)
+                size += len(chunk)
+                if size >= CHUNK_SIZE:
+                    text = "".join(buffered)
+                    out.write(text)
+                    buffered = []
+                    size = 0
+                    # checked per chunk, a single /8 takes a while on its own
+                    if LIST_PROGRESS:
+                        done += text.count("\n")
+                        if time.time() - reported >= 1:
+                            reported = time.time()
+                            eta = (reported - started) / done * (total - done)
+                            print("# {} {}/{} hosts ({:.0%}), ETA {:.0f}s".format(
+                                cc, done, total, done / total, eta), file=sys.stderr)
+        out.write("".join(buffered))
+
+
+def build_lookup_index():
+    # sorted (start, end, label) columns over the tables of all registries.
+    # IPv6 is keyed by the upper 64 bits, no registry delegates beyond a /64
+    labels = {}
+    rows = {32: [], 128: []}
+    for rir in RIR_TABLES.keys():
+        table = CACHE[rir]
+        if len(table) == 0:
+            # an index without it would answer unknown for a whole registry
+            raise RIRUnavailable("No RIR table for {}, not building a lookup index".format(rir))
+        unallocated = [status in UNALLOCATED for status in table["statuses"]]
+        for (cc, rtype), entries in table["index"].items():
+            if rtype not in ("ipv4", "ipv6") or cc in ("", "ZZ"):
+                continue
+            label = labels.setdefault((cc, rir), len(labels))
+            for row in entries:
+                if unallocated[table["status"][row]]:
+                    continue
+                bits, start, count = row_range(table, row)
+                end = start + count - 1
+                if bits == 128:
+                    start, end = start >> 64, end >> 64
+                rows[bits].append((start, end, label))
+
+    index = {"labels": [None] * len(labels)}
+    for (cc, rir), label in labels.items():
+        index["labels"][label] = "{} {}".format(cc, rir)
+    for bits, code in ((32, "I"), (128, "Q")):
+        rows[bits].sort()
+        index[bits] = (
+            array.array(code, (r[0] for r in rows[bits])),
+            array.array(code, (r[1] for r in rows[bits])),
+            array.array("H", (r[2] for r in rows[bits])),
+        )
+    return index
+
+
+def write_lookup_index(path, index):
+    # GEOIPIX1, header length, JSON header, then the 8 byte aligned columns
+    header = json.dumps({
+        "labels": index["labels"],
+        "byteorder": sys.byteorder,
+        "v4": len(index[32][0]),
+        "v6": len(index[128][0]),
+    }).encode()
+    header += b" " * (-(len(header) + 12) % 8)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path + ".tmp", "wb") as f:
+        f.write(b"GEOIPIX1")
+        f.write(struct.pack("<I", len(header)))
+        f.write(header)
+        for bits in (128, 32):
+            for column in index[bits]:
+                column.tofile(f)
+                f.write(b"\0" * (-len(column) * column.itemsize % 8))
+    os.replace(path + ".tmp", path)
+
+
+def read_lookup_index(path):
+    # map the columns straight from the file, nothing is parsed or copied
+    with open(path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if mm[:8] != b"GEOIPIX1":
+        raise ValueError("{} is no lookup index".format(path))
+    length, = struct.unpack("<I", mm[8:12])
+    header = json.loads(mm[12:12 + length])
+    if header["byteorder"] != sys.byteorder:
+        raise ValueError("{} was written on a different architecture".format(path))
+
+    index = {"labels": header["labels"]}
+    offset = 12 + length
+    for bits, code, count in ((128, "Q", header["v6"]), (32, "I", header["v4"])):
+        columns = []
+        for column_code in (code, code, "H"):
+            size = count * struct.calcsize(column_code)
+            if numpy is not None:
+                columns.append(numpy.frombuffer(mm, dtype=numpy.dtype(column_code), count=count, offset=offset))
+            else:
+                columns.append(memoryview(mm)[offset:offset + size].cast(column_code))
+            offset += size + (-size % 8)
+        index[bits] = tuple(columns)
+    return index
+
+
+def lookup_keys(index, bits, keys):
+    # -> label index for every key, len(labels) if it is not allocated
+    starts, ends, label = index[bits]
+    unknown = len(index["labels"])
+    if numpy is not None and isinstance(starts, numpy.ndarray):
+        values = numpy.asarray(keys, dtype=starts.dtype)
+        if not len(starts):
+            return [unknown] * len(values)
+        pos = numpy.searchsorted(starts, values, side="right") - 1
+        hit = (pos >= 0) & (values <= ends[pos.clip(0)])
+        return numpy.where(hit, label[pos.clip(0)], unknown).tolist()
+    found = []
+    for value in keys:
+        pos = bisect.bisect_right(starts, value) - 1
+        found.append(label[pos] if pos >= 0 and value <= ends[pos] else unknown)
+    return found
+
 
+def lookup(index, addresses):
+    # -> "CC RIR" for every address, None if unknown or malformed
+    labels = index["labels"] + [None]
+    pton = socket.inet_pton
+    try:
+        # fast path for the usual batch of nothing but IPv4 addresses
+        packed = b"".join([pton(socket.AF_INET, address) for address in addresses])
+    except OSError:
+        packed = None
+    if packed is not None:
+        keys = array.array("I", packed)
+        if sys.byteorder == "little":
+            keys.byteswap()
+        return [labels[i] for i in lookup_keys(index, 32, keys)]
+
+    keys = {32: [], 128: []}
+    slots = {32: [], 128: []}
+    result = [None] * len(addresses)
+    for i, address in enumerate(addresses):
+        try:
+            value, bits = ip_to_int(address)
+        except (OSError, ValueError):
+            continue
+        keys[bits].append(value if bits == 32 else value >> 64)
+        slots[bits].append(i)
+    for bits in (32, 128):
+        if keys[bits]:
+            for slot, i in zip(slots[bits], lookup_keys(index, bits, keys[bits])):
+                result[slot] = labels[i]
+    return result
+
+
+def load_lookup_index(path = None, rebuild = False, stale = True):
+    # reuse a recent index file, otherwise build it from all RIR tables. if
+    # one of them is unavailable an outdated index file is still used if
+    # `stale`, an incomplete index is never built nor written
+    if path is None and CACHE_DIR is not None:
+        path = cache_path("lookup", "idx")
+    if path is not None and not rebuild:
+        try:
+            if OFFLINE or time.time() - os.path.getmtime(path) < INDEX_MAX_AGE:
+                return read_lookup_index(path)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            print("# Rebuilding lookup index: {}".format(e), file=sys.stderr)
+
+    try:
+        prefetch(RIR_TABLES.keys())
+        index = build_lookup_index()
+    except RIRUnavailable as e:
+        if not stale or rebuild or path is None or not os.path.exists(path):
+            raise
+        print("# {}, using the outdated lookup index {}".format(e, path), file=sys.stderr)
+        return read_lookup_index(path)
+    if path is not None:
+        try:
+            write_lookup_index(path, index)
+        except OSError as e:
+            print("# Could not write lookup index {}: {}".format(path, e), file=sys.stderr)
+    return index
+
+
+def lookup_files(index, files, out):
+    # resolve one address per line, LOOKUP_BATCH lines at a time
+    streams = [open(f) for f in files] if files else [sys.stdin]
+    for stream in streams:
+        while True:
+            batch = [line.strip() for line in stream.readlines(LOOKUP_BATCH * 16)]
+            if not batch:
+                break
+            out.write("".join([
+                address + " " + (label or "-- --") + "\n" for address, label in zip(batch, lookup(index, batch))
+            ]))
+        if stream is not sys.stdin:
+            stream.close()
+
+
+def write_metrics(path):
+    # JSON, or a Prometheus textfile collector file if the name ends in .prom
+    METRICS["seconds"] = time.time() - METRICS["started"]
+    # ru_maxrss is in KiB on Linux
+    METRICS["peak_rss_bytes"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    if path.endswith(".prom"):
+        lines = []
+        for name, key, section, label in (
+            ("registry_bytes", "bytes", "registries", "registry"),
+            ("registry_download_seconds", "download_seconds", "registries", "registry"),
+            ("registry_parse_seconds", "parse_seconds", "registries", "registry"),
+            ("registry_cache_seconds", "cache_seconds", "registries", "registry"),
+            ("registry_records", "records", "registries", "registry"),
+            ("country_filter_seconds", "filter_seconds", "countries", "country"),
+            ("country_generate_seconds", "generate_seconds", "countries", "country"),
+            ("country_allocations", "allocations", "countries", "country"),
+            ("country_prefixes", "prefixes", "countries", "country"),
+        ):
+            lines.append("# TYPE geoip_{} gauge".format(name))
+            for item, stats in sorted(METRICS[section].items()):
+                lines.append('geoip_{}{{{}="{}"}} {}'.format(name, label, item, stats[key]))
+        lines.append("# TYPE geoip_run_seconds gauge")
+        lines.append("geoip_run_seconds {}".format(METRICS["seconds"]))
+        lines.append("# TYPE geoip_peak_rss_bytes gauge")
+        lines.append("geoip_peak_rss_bytes {}".format(METRICS["peak_rss_bytes"]))
+        lines.append("# TYPE geoip_last_run_timestamp_seconds gauge")
+        lines.append("geoip_last_run_timestamp_seconds {}".format(METRICS["started"]))
+        text = "\n".join(lines) + "\n"
+    else:
+        text = json.dumps(METRICS, indent=2) + "\n"
 
-def generate_list(cc, net):
-    for e in generate_range(cc, net, True):
-        for h in list(e.hosts()):
-            print(format(h))
+    # textfile collectors must never see a partial file
+    with open(path + ".tmp", "w") as f:
+        f.write(text)
+    os.replace(path + ".tmp", path)
+
+
+def write_profile(path):
+    # one dump of the main thread and all workers
+    stats = pstats.Stats(PROFILERS[0])
+    for profiler in PROFILERS[1:]:
+        stats.add(profiler)
+    stats.dump_stats(path)
+
+
+def reload_lookup_index(path = None, rebuild = False, stale = True):
+    # fresh tables every time, the daemon only keeps the index afterwards
+    for rir in CACHE.keys():
+        CACHE[rir] = {}
+    HEADERS.clear()
+    try:
+        return load_lookup_index(path, rebuild, stale)
+    finally:
+        for rir in CACHE.keys():
+            CACHE[rir] = {}
+
+
+def cached_lookup(current, addresses):
+    # lookup() with an LRU cache of the answers in front of it
+    index, cache = current
+    result = [None] * len(addresses)
+    missing = []
+    for i, address in enumerate(addresses):
+        try:
+            result[i] = cache[address]
+            cache.move_to_end(address)
+        except KeyError:
+            missing.append(i)
+    if missing:
+        found = lookup(index, [addresses[i] for i in missing])
+        for i, label in zip(missing, found):
+            result[i] = label
+            cache[addresses[i]] = label
+        while len(cache) > SERVE_CACHE_SIZE:
+            cache.popitem(last=False)
+    return result
+
+
+async def serve_lookups(socket_path, index_path = None, rebuild = False):
+    # answer lines of addresses with lines like -lookup does, everything a
+    # client has sent so far is resolved as one batch. a refreshed index is
+    # swapped in as a whole, requests already running keep the old one
+    loop = asyncio.get_running_loop()
+    index = await loop.run_in_executor(None, profiled, reload_lookup_index, index_path, rebuild)
+    state = {"current": (index, collections.OrderedDict())}
+
+    async def handle(reader, writer):
+        rest = b""
+        try:
+            while True:
+                chunk = await reader.read(CHUNK_SIZE)
+                if chunk:
+                    lines = (rest + chunk).split(b"\n")
+                    rest = lines.pop()
+                elif rest:
+                    # the last line needs no newline, answer it at EOF
+                    lines, rest = [rest], b""
+                else:
+                    break
+                if lines:
+                    addresses = [line.decode("utf-8", "replace").strip() for line in lines]
+                    labels = cached_lookup(state["current"], addresses)
+                    writer.write("".join([
+                        address + " " + (label or "-- --") + "\n" for address, label in zip(addresses, labels)
+                    ]).encode())
+                    await writer.drain()
+                if len(rest) > SERVE_MAX_LINE:
+                    # no address is that long, do not buffer it forever
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def reload():
+        while True:
+            try:
+                await asyncio.wait_for(reload_requested.wait(), SERVE_RELOAD)
+            except asyncio.TimeoutError:
+                pass
+            reload_requested.clear()
+            # without all tables the index in use is kept, not an outdated file
+            try:
+                index = await loop.run_in_executor(None, profiled, reload_lookup_index, index_path, False, False)
+            except Exception as e:
+                print("# Keeping the current lookup index, reload failed: {}".format(e), flush=True)
+                continue
+            state["current"] = (index, collections.OrderedDict())
+            print("# Swapped in lookup index with {} IPv4 and {} IPv6 ranges".format(
+                len(index[32][0]), len(index[128][0])), flush=True)
+
+    reload_requested = asyncio.Event()
+    loop.add_signal_handler(signal.SIGHUP, reload_requested.set)
+    # shut down cleanly, removing the socket
+    loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    server = await asyncio.start_unix_server(handle, path=socket_path)
+    print("# Serving lookups on {}".format(socket_path), flush=True)
+    reloader = asyncio.create_task(reload())
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        reloader.cancel()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+
+def pop_option(argv, name, default = None):
+    # remove `name value` from argv and return the value
+    if name not in argv:
+        return default
+    i = argv.index(name)
+    argv.pop(i)
+    if i >= len(argv):
+        print("# Missing value for {}".format(name))
+        sys.exit(1)
+    return argv.pop(i)
 
 
 if __name__ == '__main__':
     net = "all"
     mode = "cidr"
     sys.argv.pop(0)
+    CACHE_DIR = pop_option(sys.argv, "-cache-dir", CACHE_DIR)
+    CACHE_MAX_AGE = int(pop_option(sys.argv, "-max-age", CACHE_MAX_AGE))
+    INDEX_MAX_AGE = int(pop_option(sys.argv, "-index-max-age", INDEX_MAX_AGE))
+    LIST_MAX_HOSTS = int(pop_option(sys.argv, "-max-hosts", LIST_MAX_HOSTS))
+    if "-progress" in sys.argv:
+        sys.argv.remove("-progress")
+        LIST_PROGRESS = True
+    # written on exit, so also by the runs that stop early
+    metrics_path = pop_option(sys.argv, "-metrics")
+    if metrics_path is not None:
+        atexit.register(write_metrics, metrics_path)
+    profile_path = pop_option(sys.argv, "-profile")
+    if profile_path is not None:
+        PROFILERS = [cProfile.Profile()]
+        atexit.register(write_profile, profile_path)
+        PROFILERS[0].enable()
+    MIRROR = pop_option(sys.argv, "-mirror", MIRROR)
+    if "-no-cache" in sys.argv:
+        sys.argv.remove("-no-cache")
+        CACHE_DIR = None
+    if "-offline" in sys.argv:
+        sys.argv.remove("-offline")
+        OFFLINE = True
     if "-4" in sys.argv:
         sys.argv.remove("-4")
         net = "ipv4"
@@ -315,16 +1425,106 @@ if __name__ == '__main__':
     if "-range" in sys.argv:
         sys.argv.remove("-range")
         mode = "range"
+    # complete `ipset restore` script or `nft -f` batch instead of plain prefixes
+    if "-ipset" in sys.argv:
+        sys.argv.remove("-ipset")
+        mode = "ipset"
+    if "-nft" in sys.argv:
+        sys.argv.remove("-nft")
+        mode = "nft"
+    output = pop_option(sys.argv, "-o")
+    index_path = pop_option(sys.argv, "-index")
+    rebuild = "-rebuild" in sys.argv
+    if rebuild:
+        sys.argv.remove("-rebuild")
+    # answer lookups on a Unix socket until terminated
+    if "-serve" in sys.argv:
+        sys.argv.remove("-serve")
+        SERVE_CACHE_SIZE = int(pop_option(sys.argv, "-cache-size", SERVE_CACHE_SIZE))
+        SERVE_RELOAD = int(pop_option(sys.argv, "-reload", SERVE_RELOAD))
+        socket_path = pop_option(sys.argv, "-socket", SOCKET_PATH)
+        try:
+            asyncio.run(serve_lookups(socket_path, index_path, rebuild))
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            pass
+        except RIRUnavailable as e:
+            print("# {}".format(e))
+            sys.exit(1)
+        sys.exit(0)
+    # resolve addresses from the given files or stdin to country and registry
+    if "-lookup" in sys.argv:
+        sys.argv.remove("-lookup")
+        # keep stdout clean for the results
+        with contextlib.redirect_stdout(sys.stderr):
+            try:
+                index = load_lookup_index(index_path, rebuild)
+            except RIRUnavailable as e:
+                print("# {}".format(e))
+                sys.exit(1)
+        lookup_files(index, sys.argv, sys.stdout)
+        sys.exit(0)
+    # set name of -merge in ipset/nft mode
+    merged_name = pop_option(sys.argv, "-name", "geoip")
+    # merge adjacent and overlapping prefixes of a country
+    aggregated = False
+    if "-aggregate" in sys.argv:
+        sys.argv.remove("-aggregate")
+        aggregated = True
+    # only emit the changes since the run that wrote this state file
+    state_path = pop_option(sys.argv, "-diff")
+    # aggregate all countries into a single list of prefixes
+    merged = None
+    if "-merge" in sys.argv:
+        sys.argv.remove("-merge")
+        merged = []
+
+    try:
+        prefetch(ISO_RIR[cc] for cc in sys.argv if cc in ISO_RIR.keys())
+    except RIRUnavailable as e:
+        print("# {}".format(e))
+        sys.exit(1)
+
+    sets = []
+
+    if state_path is not None and mode in ("ipset", "nft"):
+        state = read_state(state_path)
+        sources = {rir: source_id(rir) for rir in RIR_TABLES.keys() if rir in HEADERS}
+        # without a registry its countries would look empty and the diff would
+        # remove all of their prefixes, so never write sets or state without it
+        missing = sorted({ISO_RIR[cc] for cc in sys.argv if cc in ISO_RIR.keys()} - sources.keys())
+        if missing:
+            print("# No RIR table for {}, leaving {} untouched".format(", ".join(missing), state_path))
+            sys.exit(1)
+        key = {"mode": mode, "net": net, "countries": sys.argv, "merge": merged_name if merged is not None else None}
+        if state_unchanged(state, sources, key):
+            print("# RIR tables unchanged since the last run, nothing to do")
+            write_sets([], mode, output)
+            sys.exit(0)
 
     for cc in sys.argv:
         if cc not in ISO_RIR.keys():
             print("# Ignoring unknown Code: {}".format(cc))
             continue
-        if mode == "cidr":
-            generate_cidr(cc, net)
+        if mode in ("cidr", "ipset", "nft") and merged is not None:
+            merged.extend(generate_range(cc, net, True))
+        elif mode in ("ipset", "nft"):
+            sets.extend(generate_sets(cc, generate_range(cc, net, True), net))
+        elif mode == "cidr":
+            generate_cidr(cc, net, aggregated)
         elif mode == "list":
             generate_list(cc, net)
         elif mode == "range":
             generate_range(cc, net)
         else:
             print("# Unkown mode {}".format(mode))
+
+    if mode == "cidr" and merged is not None:
+        print_cidr(aggregate(merged))
+    elif mode in ("ipset", "nft"):
+        if merged is not None:
+            sets = generate_sets(merged_name, merged, net)
+        if state_path is not None:
+            new_sets = write_diff(sets, mode, state_path, state, output)
+            write_state(state_path, {"sources": sources, "key": key, "sets": new_sets})
+        else:
+            write_sets(sets, mode, output)
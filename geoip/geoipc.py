@@ -0,0 +1,96 @@
+import sys
+import socket
+import time
+import random
+import threading
+
+# keep in sync with geoip.SOCKET_PATH, this client must not import geoip
+# as that pulls in urllib3 and friends for every single lookup
+SOCKET_PATH = "/run/geoip.sock"
+TIMEOUT = 2
+
+
+def connect(path):
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.settimeout(TIMEOUT)
+    s.connect(path)
+    return s
+
+
+def query(s, reader, addresses):
+    # -> "address CC RIR" lines, one per address in the same order
+    s.sendall("".join(address + "\n" for address in addresses).encode())
+    return [reader.readline().decode().rstrip("\n") for _ in addresses]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def bench(path, requests, batch, concurrency):
+    # load test: `concurrency` connections sending `requests` batches in total
+    latencies = []
+    lock = threading.Lock()
+
+    def worker(count):
+        rnd = random.Random()
+        s = connect(path)
+        reader = s.makefile("rb")
+        own = []
+        for _ in range(count):
+            addresses = ["{}.{}.{}.{}".format(rnd.randrange(1, 224), rnd.randrange(256), rnd.randrange(256), rnd.randrange(256))
+                         for _ in range(batch)]
+            started = time.perf_counter()
+            query(s, reader, addresses)
+            own.append(time.perf_counter() - started)
+        s.close()
+        with lock:
+            latencies.extend(own)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(requests // concurrency + (i < requests % concurrency),))
+               for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    print("# {} requests of {} addresses over {} connections in {:.2f}s".format(len(latencies), batch, concurrency, elapsed))
+    print("# {:.0f} requests/s, {:.0f} addresses/s".format(len(latencies) / elapsed, len(latencies) * batch / elapsed))
+    print("# latency p50 {:.3f}ms p99 {:.3f}ms max {:.3f}ms".format(
+        percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000, max(latencies) * 1000))
+
+
+def pop_option(argv, name, default = None):
+    if name not in argv:
+        return default
+    i = argv.index(name)
+    argv.pop(i)
+    if i >= len(argv):
+        print("# Missing value for {}".format(name))
+        sys.exit(1)
+    return argv.pop(i)
+
+
+if __name__ == '__main__':
+    sys.argv.pop(0)
+    path = pop_option(sys.argv, "-socket", SOCKET_PATH)
+    requests = pop_option(sys.argv, "-bench")
+    batch = int(pop_option(sys.argv, "-batch", 1))
+    concurrency = int(pop_option(sys.argv, "-concurrency", 1))
+
+    if requests is not None:
+        bench(path, int(requests), batch, concurrency)
+        sys.exit(0)
+
+    # addresses from the arguments, or one per line from stdin
+    s = connect(path)
+    reader = s.makefile("rb")
+    if sys.argv:
+        print("\n".join(query(s, reader, sys.argv)))
+    else:
+        for line in sys.stdin:
+            print(query(s, reader, [line.strip()])[0])
+    s.close()
@@ -1,32 +1,85 @@
 #!/bin/bash
 
+COUNTRIES="RU BY KP CN"
+# prefixes loaded by the previous run, only the difference is applied. it
+# lives in /run like the kernel sets, so a reboot starts with a full rebuild
+STATE=/run/geoip/state.json
 
-iptables -F geoip-input
-ip6tables -F geoip6-input
-iptables -F geoip-output
-ip6tables -F geoip6-output
+RESTORE=$(mktemp)
+trap 'rm -f "$RESTORE"' EXIT
 
-for cc in RU BY KP CN
+mkdir -p "$(dirname "$STATE")"
+
+SETS=$(ipset list -n)
+for cc in $COUNTRIES
 do
-	ipset create ipnet-$cc hash:net -4 || true
-	ipset flush ipnet-$cc
-	ipset create ip6net-$cc hash:net -6 || true
-	ipset flush ip6net-$cc
-	while read network
+	for set in ipnet-$cc:inet ip6net-$cc:inet6
 	do
+		name=${set%:*}
+		# leftovers of a restore that failed halfway
+		if grep -qxF -- "$name-tmp" <<< "$SETS"
+		then
+			ipset destroy "$name-tmp"
+		fi
+		# the restore script swaps new contents into the live sets, which
+		# only needs type and family to match, so existing ones are kept
+		# as they are. the state only describes sets that still exist,
+		# rebuild everything if one is gone
+		if ! grep -qxF -- "$name" <<< "$SETS"
+		then
+			ipset create "$name" hash:net family "${set#*:}" || exit 1
+			rm -f "$STATE"
+		fi
+	done
+done
+
+# build all sets in one `ipset restore` transaction, new sets are filled
+# under a temporary name and swapped in, known sets only get the prefixes
+# added and removed since the last run, so the live sets stay complete
+python3 ./geoip.py -ipset -diff "$STATE" -o "$RESTORE" $COUNTRIES || exit 1
+if ! ipset restore < "$RESTORE"
+then
+	# the state no longer matches the kernel, rebuild everything next time
+	rm -f "$STATE"
+	exit 1
+fi
 
-		if [[ $network =~ ":" ]]
+# the chains are never flushed, so the rules keep dropping throughout the
+# reload. missing rules are added, the ones of countries no longer listed
+# are deleted. keep going if one fails, but report it
+STATUS=0
+
+ensure() {
+	local cmd=$1
+	shift
+	$cmd -C "$@" 2>/dev/null || $cmd -A "$@" || STATUS=1
+}
+
+prune() {
+	local cmd=$1 chain=$2 rule cc
+	while read -r rule
+	do
+		cc=${rule##*GEOIP_BLOCK_}
+		cc=${cc%% *}
+		if [[ " $COUNTRIES " != *" $cc "* ]]
 		then
-			ipset add ip6net-$cc $network
-		else
-			ipset add ipnet-$cc $network
+			$cmd -D ${rule#-A } || STATUS=1
 		fi
+	done < <($cmd -S "$chain" | grep -F -- "--comment GEOIP_BLOCK_")
+}
 
-	done < <(python3 ./geoip.py -cidr $cc | grep -v '^#')
-	
-	iptables -A geoip-input -m set --match-set ipnet-$cc src -m comment --comment GEOIP_BLOCK_$cc -j DROP
-	ip6tables -A geoip6-input -m set --match-set ip6net-$cc src -m comment --comment GEOIP_BLOCK_$cc -j DROP
+for cc in $COUNTRIES
+do
+	ensure iptables geoip-input -m set --match-set ipnet-$cc src -m comment --comment GEOIP_BLOCK_$cc -j DROP
+	ensure ip6tables geoip6-input -m set --match-set ip6net-$cc src -m comment --comment GEOIP_BLOCK_$cc -j DROP
 
-	iptables -A geoip-output -m set --match-set ipnet-$cc dst -m comment --comment GEOIP_BLOCK_$cc -j DROP
-	ip6tables -A geoip6-output -m set --match-set ip6net-$cc dst -m comment --comment GEOIP_BLOCK_$cc -j DROP
+	ensure iptables geoip-output -m set --match-set ipnet-$cc dst -m comment --comment GEOIP_BLOCK_$cc -j DROP
+	ensure ip6tables geoip6-output -m set --match-set ip6net-$cc dst -m comment --comment GEOIP_BLOCK_$cc -j DROP
 done
+
+prune iptables geoip-input
+prune ip6tables geoip6-input
+prune iptables geoip-output
+prune ip6tables geoip6-output
+
+exit $STATUS
@@ -0,0 +1,389 @@
+import io
+import os
+import json
+import array
+import asyncio
+import random
+import shutil
+import tempfile
+import time
+import ipaddress
+import unittest
+import contextlib
+from unittest import mock
+
+import geoip
+import bench
+
+TESTDATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "testdata")
+
+# (name, bits, [(bits, network, prefix length)]) as generate_sets() returns them
+SETS = [
+    ("DE", 32, [(32, 0x02000000, 16), (32, 0x05010000, 24), (32, 0x05010400, 22)]),
+    ("DE", 128, [(128, 0x20010db8 << 96, 32), (128, 0x2a000001 << 96, 48)]),
+    ("KP", 32, [(32, 0xaf2db000, 22)]),
+    ("KP", 128, []),
+]
+
+# (name, bits, added, removed) as write_diff() passes them to write_changes()
+CHANGES = [
+    ("DE", 32, [(0x05020000, 24), (0x05030000, 24)], [(0x05010400, 22)]),
+    ("DE", 128, [], [(0x2a000001 << 96, 48)]),
+    ("KP", 32, [(0xaf2db400, 24)], []),
+]
+
+# a small delegated-extended file of RIPE, four allocations of Germany
+TABLE = """2.3|ripencc|20261017|4|19830705|20261016|+0100
+ripencc|*|asn|*|1|summary
+ripencc|*|ipv4|*|2|summary
+ripencc|*|ipv6|*|1|summary
+ripencc|DE|asn|3320|1|19930901|allocated|0a1b2c3d
+ripencc|DE|ipv4|2.160.0.0|1048576|20100304|allocated|0a1b2c3d
+ripencc|DE|ipv4|5.1.0.0|768|20120111|allocated|0a1b2c3d
+ripencc|DE|ipv6|2003::|19|20050124|allocated|0a1b2c3d
+"""
+
+
+def random_ranges(rnd, bits, n):
+    # (start, count) pairs within the address space, the edge cases first
+    size = 1 << bits
+    ranges = [(0, size), (0, 1), (size - 1, 1), (0, size - 1), (1, size - 1), (size // 2 - 1, 2)]
+    while len(ranges) < n:
+        count = rnd.choice([
+            rnd.randrange(1, 1 << 10),
+            rnd.randrange(1, 1 << rnd.randrange(1, bits + 1)),
+            1 << rnd.randrange(0, bits + 1),
+            3 << rnd.randrange(0, bits - 1),
+        ])
+        count = min(count, size)
+        ranges.append((rnd.randrange(0, size - count + 1), count))
+    return ranges
+
+
+def summarize(start, count, bits):
+    # the reference decomposition of ipaddress
+    address = ipaddress.IPv4Address if bits == 32 else ipaddress.IPv6Address
+    return [
+        (int(net.network_address), net.prefixlen)
+        for net in ipaddress.summarize_address_range(address(start), address(start + count - 1))
+    ]
+
+
+class RangeToCidrTest(unittest.TestCase):
+    def check(self, cidrs, start, count, bits):
+        # the blocks tile [start, start + count) exactly, each aligned to its size
+        covered = start
+        for network, prefixlen in cidrs:
+            size = 1 << (bits - prefixlen)
+            self.assertEqual(network, covered)
+            self.assertEqual(network % size, 0)
+            covered += size
+        self.assertEqual(covered, start + count)
+
+    def test_ipv4(self):
+        rnd = random.Random(4)
+        for start, count in random_ranges(rnd, 32, 2000):
+            cidrs = list(geoip.range_to_cidr(start, count, 32))
+            self.check(cidrs, start, count, 32)
+            # summarize_address_range is minimal, so is anything equal to it
+            self.assertEqual(cidrs, summarize(start, count, 32))
+
+    def test_ipv6(self):
+        rnd = random.Random(6)
+        for start, count in random_ranges(rnd, 128, 2000):
+            cidrs = list(geoip.range_to_cidr(start, count, 128))
+            self.check(cidrs, start, count, 128)
+            self.assertEqual(cidrs, summarize(start, count, 128))
+
+    def test_ranges_in_order(self):
+        ranges = [(256, 768), (0, 1), (1 << 24, 3 << 10)]
+        expected = [c for start, count in ranges for c in summarize(start, count, 32)]
+        self.assertEqual(geoip.ranges_to_cidr(ranges, 32), expected)
+
+    @unittest.skipIf(geoip.numpy is None, "NumPy is not installed")
+    def test_numpy_matches_python(self):
+        rnd = random.Random(32)
+        ranges = random_ranges(rnd, 32, 5000)
+        expected = [c for start, count in ranges for c in geoip.range_to_cidr(start, count, 32)]
+        self.assertEqual(geoip.ranges_to_cidr_numpy(ranges), expected)
+        self.assertEqual(geoip.ranges_to_cidr_numpy([]), [])
+
+
+class ParseListTest(unittest.TestCase):
+    def test_table(self):
+        table = geoip.parse_list(TABLE.splitlines())
+        self.assertEqual(table["malformed"], 0)
+        self.assertEqual(list(table["index"][("DE", "ipv4")]), [1, 2])
+        self.assertEqual(geoip.table_row(table, 2), ("ripencc", "DE", "ipv4", "5.1.0.0", "768", "20120111", "allocated"))
+        self.assertEqual(geoip.row_range(table, 3), (128, 0x2003 << 112, 1 << 109))
+
+    def test_malformed(self):
+        rows = [
+            "ripencc|DE|ipv6|2003::|129|20050124|allocated",
+            "ripencc|DE|ipv6|2003::|-1|20050124|allocated",
+            "ripencc|DE|ipv4|5.1.0.0|0|20120111|allocated",
+            "ripencc|DE|ipv4|255.255.255.0|512|20120111|allocated",
+            "ripencc|DE|ipv4|2003::|256|20120111|allocated",
+            "ripencc|DE|ipv6|5.1.0.0|24|20120111|allocated",
+            "ripencc|DE|ipv4|5.1.0.0|many|20120111|allocated",
+            "ripencc|DE|ipv4|5.1.0.0",
+        ]
+        table = geoip.parse_list(TABLE.splitlines() + rows)
+        self.assertEqual(table["malformed"], len(rows))
+        self.assertEqual(len(table["type"]), 4)
+
+
+class WriteSetsTest(unittest.TestCase):
+    # compare against the checked-in ipset restore scripts and nft batches
+    def check(self, name, write):
+        out = io.StringIO()
+        write(out)
+        with open(os.path.join(TESTDATA, name)) as f:
+            self.assertEqual(out.getvalue(), f.read())
+
+    def test_ipset(self):
+        self.check("sets.ipset", lambda out: geoip.write_ipset(SETS, out))
+
+    def test_ipset_changes(self):
+        self.check("changes.ipset", lambda out: geoip.write_changes(CHANGES, "ipset", out))
+
+    # small batches so the splitting of long element lists is covered too
+    @mock.patch.object(geoip, "NFT_CHUNK", 2)
+    def test_nft(self):
+        self.check("sets.nft", lambda out: geoip.write_nft(SETS, out))
+
+    @mock.patch.object(geoip, "NFT_CHUNK", 2)
+    def test_nft_changes(self):
+        self.check("changes.nft", lambda out: geoip.write_changes(CHANGES, "nft", out))
+
+
+class TruncatingHandler(bench.QuietHandler):
+    # announces the full Content-Length, then sends only the first 100 bytes
+    truncate = True
+
+    def copyfile(self, source, outputfile):
+        if not self.truncate:
+            return super().copyfile(source, outputfile)
+        outputfile.write(source.read(100))
+
+
+class StallingHandler(bench.QuietHandler):
+    # sends the headers, then nothing for a second
+    def copyfile(self, source, outputfile):
+        outputfile.flush()
+        time.sleep(1)
+
+
+class CacheTest(unittest.TestCase):
+    # fetch_list() against bench.py's local stand-in for the RIR servers
+    def setUp(self):
+        self.mirror = tempfile.mkdtemp(prefix="geoip-test-")
+        self.addCleanup(shutil.rmtree, self.mirror, ignore_errors=True)
+        with open(os.path.join(self.mirror, "delegated-ripencc-extended-latest"), "w") as f:
+            f.write(TABLE)
+        for name, value in (
+            ("CACHE_DIR", os.path.join(self.mirror, "cache")),
+            ("CACHE_MAX_AGE", 0),
+            ("OFFLINE", False),
+            ("METRICS", {"registries": {}, "countries": {}}),
+        ):
+            patcher = mock.patch.object(geoip, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def fetch(self, url):
+        with mock.patch.object(geoip, "MIRROR", url):
+            table = geoip.fetch_list("RIPE", lambda line: None)
+        return table, geoip.registry_metrics("RIPE")["source"]
+
+    def test_download_then_not_modified(self):
+        with bench.serve(self.mirror) as url:
+            table, source = self.fetch(url)
+            self.assertEqual(source, "download")
+            self.assertEqual(len(table["type"]), 4)
+            with mock.patch.object(geoip, "parse_list") as parse:
+                table, source = self.fetch(url)
+        parse.assert_not_called()
+        self.assertEqual(source, "not-modified")
+        self.assertEqual(len(table["type"]), 4)
+
+    def test_max_age(self):
+        with bench.serve(self.mirror) as url:
+            self.fetch(url)
+        # the server is gone, so anything but the cache would be stale or fail
+        with mock.patch.object(geoip, "CACHE_MAX_AGE", 3600), mock.patch.object(geoip, "parse_list") as parse:
+            table, source = self.fetch(url)
+        parse.assert_not_called()
+        self.assertEqual(source, "cache")
+        self.assertEqual(len(table["type"]), 4)
+
+    def test_offline(self):
+        with mock.patch.object(geoip, "OFFLINE", True):
+            with self.assertRaises(geoip.RIRUnavailable):
+                self.fetch("http://127.0.0.1:1")
+            with bench.serve(self.mirror) as url:
+                with mock.patch.object(geoip, "OFFLINE", False):
+                    self.fetch(url)
+            table, source = self.fetch("http://127.0.0.1:1")
+        self.assertEqual(source, "cache")
+        self.assertEqual(len(table["type"]), 4)
+
+    def test_stale(self):
+        with bench.serve(self.mirror) as url:
+            self.fetch(url)
+        table, source = self.fetch(url)
+        self.assertEqual(source, "stale")
+        self.assertEqual(len(table["type"]), 4)
+
+    def test_truncated_body(self):
+        with bench.serve(self.mirror, TruncatingHandler) as url:
+            with self.assertRaises(geoip.RIRUnavailable):
+                self.fetch(url)
+        with bench.serve(self.mirror, TruncatingHandler) as url:
+            with mock.patch.object(TruncatingHandler, "truncate", False):
+                self.fetch(url)
+            # newer than the cached copy, so it is downloaded again
+            path = os.path.join(self.mirror, "delegated-ripencc-extended-latest")
+            os.utime(path, (os.path.getmtime(path) + 10,) * 2)
+            table, source = self.fetch(url)
+        self.assertEqual(source, "stale")
+        self.assertEqual(len(table["type"]), 4)
+
+    # a fresh connection pool, the timeouts are set when it is created
+    @mock.patch.object(geoip, "HTTP", None)
+    @mock.patch.object(geoip, "HTTP_READ_TIMEOUT", 0.2)
+    def test_stalled_server(self):
+        with bench.serve(self.mirror, StallingHandler) as url:
+            started = time.monotonic()
+            with self.assertRaises(geoip.RIRUnavailable):
+                self.fetch(url)
+            self.assertLess(time.monotonic() - started, 0.9)
+
+    def test_missing(self):
+        with self.assertRaises(geoip.RIRUnavailable):
+            self.fetch("http://127.0.0.1:1")
+        self.assertEqual(geoip.registry_metrics("RIPE")["source"], "missing")
+
+
+class DiffTest(unittest.TestCase):
+    OLD = [(0x05010000, 24), (0x05010400, 22), (0x05020000, 24)]
+
+    def diff(self, sets, state):
+        # -> (lines of the restore script, sets of the new state)
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            new_sets = geoip.write_diff(sets, "ipset", None, state)
+        return [line for line in out.getvalue().splitlines() if not line.startswith("#")], new_sets
+
+    def state(self, prefixes):
+        # the state as write_state() leaves it, JSON turns the tuples into lists
+        sets = {"ipnet-DE": prefixes}
+        return json.loads(json.dumps({"sources": {}, "key": {}, "sets": sets}))
+
+    def test_diff_prefixes(self):
+        self.assertEqual(geoip.diff_prefixes(self.OLD, self.OLD), ([], []))
+        self.assertEqual(geoip.diff_prefixes([], self.OLD), (self.OLD, []))
+        self.assertEqual(geoip.diff_prefixes(self.OLD, []), ([], self.OLD))
+        self.assertEqual(
+            geoip.diff_prefixes(self.OLD, [(0x05000000, 24), (0x05010400, 22), (0x05030000, 24)]),
+            ([(0x05000000, 24), (0x05030000, 24)], [(0x05010000, 24), (0x05020000, 24)]),
+        )
+
+    def test_only_added(self):
+        new = sorted(self.OLD + [(0x05030000, 24)])
+        lines, _ = self.diff([("DE", 32, [(32, n, p) for n, p in new])], self.state(self.OLD))
+        self.assertEqual(lines, ["add ipnet-DE 5.3.0.0/24 -exist"])
+
+    def test_only_removed(self):
+        new = self.OLD[1:]
+        lines, _ = self.diff([("DE", 32, [(32, n, p) for n, p in new])], self.state(self.OLD))
+        self.assertEqual(lines, ["del ipnet-DE 5.1.0.0/24 -exist"])
+
+    def test_new_set_in_full(self):
+        sets = [
+            ("DE", 32, [(32, n, p) for n, p in self.OLD]),
+            ("KP", 32, [(32, 0xaf2db000, 22)]),
+        ]
+        lines, _ = self.diff(sets, self.state(self.OLD))
+        self.assertEqual(lines, [
+            "create ipnet-KP-tmp hash:net family inet maxelem {} -exist".format(geoip.IPSET_MAXELEM),
+            "flush ipnet-KP-tmp",
+            "add ipnet-KP-tmp 175.45.176.0/22",
+            "swap ipnet-KP-tmp ipnet-KP",
+            "destroy ipnet-KP-tmp",
+        ])
+        # without any state everything is written in full
+        lines, _ = self.diff(sets, None)
+        self.assertEqual(lines.count("swap ipnet-DE-tmp ipnet-DE"), 1)
+        self.assertEqual(lines.count("swap ipnet-KP-tmp ipnet-KP"), 1)
+
+    def test_state_round_trip(self):
+        sets = [("DE", 32, [(32, n, p) for n, p in self.OLD])]
+        _, new_sets = self.diff(sets, None)
+        path = os.path.join(tempfile.mkdtemp(prefix="geoip-test-"), "state.json")
+        self.addCleanup(shutil.rmtree, os.path.dirname(path), ignore_errors=True)
+        geoip.write_state(path, {"sources": {}, "key": {}, "sets": new_sets})
+        lines, again = self.diff(sets, geoip.read_state(path))
+        self.assertEqual(lines, [])
+        self.assertEqual(again, new_sets)
+
+    def test_state_unchanged(self):
+        sources = {"RIPE": "20261017/20261016"}
+        key = {"mode": "ipset", "net": "all", "countries": ["DE"], "merge": None}
+        state = json.loads(json.dumps({"sources": sources, "key": key, "sets": {}}))
+        self.assertTrue(geoip.state_unchanged(state, sources, key))
+        self.assertFalse(geoip.state_unchanged(None, sources, key))
+        self.assertFalse(geoip.state_unchanged(state, {"RIPE": "20261018/20261017"}, key))
+        self.assertFalse(geoip.state_unchanged(state, dict(sources, ARIN="20261017/20261016"), key))
+        self.assertFalse(geoip.state_unchanged(state, sources, dict(key, countries=["DE", "KP"])))
+        self.assertFalse(geoip.state_unchanged(state, sources, dict(key, net="ipv4")))
+
+
+class ServeTest(unittest.TestCase):
+    # 5.1.0.0/22 of DE in a hand made index instead of the RIR tables
+    INDEX = {
+        "labels": ["DE RIPE"],
+        32: (array.array("I", [0x05010000]), array.array("I", [0x050103ff]), array.array("H", [0])),
+        128: (array.array("Q"), array.array("Q"), array.array("H")),
+    }
+
+    def request(self, *sends):
+        # -> everything the daemon answered until it closed the connection
+        path = os.path.join(tempfile.mkdtemp(prefix="geoip-test-"), "geoip.sock")
+        self.addCleanup(shutil.rmtree, os.path.dirname(path), ignore_errors=True)
+
+        async def client():
+            server = asyncio.create_task(geoip.serve_lookups(path))
+            while not os.path.exists(path):
+                await asyncio.sleep(0.01)
+            reader, writer = await asyncio.open_unix_connection(path)
+            for data in sends:
+                if data is None:
+                    writer.write_eof()
+                else:
+                    writer.write(data)
+            answer = await asyncio.wait_for(reader.read(), 5)
+            writer.close()
+            server.cancel()
+            return answer
+
+        with mock.patch.object(geoip, "reload_lookup_index", lambda *args: self.INDEX):
+            return asyncio.run(client())
+
+    def test_lines(self):
+        answer = self.request(b"5.1.0.5\n5.1.4.0\n", None)
+        self.assertEqual(answer, b"5.1.0.5 DE RIPE\n5.1.4.0 -- --\n")
+
+    def test_last_line_without_newline(self):
+        answer = self.request(b"5.1.0.5\n5.1.3", b".255", None)
+        self.assertEqual(answer, b"5.1.0.5 DE RIPE\n5.1.3.255 DE RIPE\n")
+
+    @mock.patch.object(geoip, "SERVE_MAX_LINE", 64)
+    def test_line_too_long(self):
+        # the complete lines are still answered, then the connection is closed
+        answer = self.request(b"5.1.0.5\n" + b"5" * 100)
+        self.assertEqual(answer, b"5.1.0.5 DE RIPE\n")
+
+
+if __name__ == '__main__':
+    unittest.main()
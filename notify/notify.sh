@@ -2,13 +2,19 @@
 
 export TELEGRAM_TOKEN=REDACTED
 
+# country and registry of the remote host from the geoip.py -serve daemon
+RHOST_GEO=""
+if [ -n "$PAM_RHOST" ]
+then
+	RHOST_GEO=$(python3 "$(dirname "$0")/../geoip/geoipc.py" "$PAM_RHOST" 2>/dev/null | cut -d' ' -f2-)
+fi
 
 cat <<EOF | ./build/telegram-send 123456
 🚨🚨 [$PAM_SERVICE] [$PAM_TYPE] PAM Event on $(hostname) at $(date -Ins)
 <code>
 USER:  $PAM_RUSER
 TTY:   $PAM_TTY
-RHOST: $PAM_RHOST
+RHOST: $PAM_RHOST $RHOST_GEO
 
 $(printenv | grep -Ev 'LC_PAPER|LS_COLORS')
 </code>